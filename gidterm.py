@@ -1,16 +1,21 @@
+from array import array
+from bisect import bisect_left, bisect_right
 import codecs
-from collections import namedtuple
+from collections import deque, namedtuple
+import contextlib
 from datetime import datetime, timedelta, timezone
 import errno
 import fcntl
-import html
+import functools
+import itertools
 import os
 import pty
 import re
 from select import select
 import shlex
 import signal
-import tempfile
+import threading
+import time
 import traceback
 
 import sublime  # type: ignore
@@ -22,6 +27,26 @@ config_dir = os.path.join(this_package, 'config')
 terminal_rows = 24
 terminal_cols = 80
 
+# Maximum bytes to read from the terminal at a time. A pty read returns
+# whatever is available without waiting for the buffer to fill, so this only
+# matters for bulk output, where larger reads mean fewer syscalls and fewer,
+# longer, passes through the output parser.
+pty_read_size = 1 << 16
+
+# Minimum seconds between updates of the display while output is arriving.
+# Faster updates cannot be seen, but still cost a redraw.
+push_interval = 0.016
+
+# Characters of output to queue before the reader thread stops reading. The
+# UI takes all queued output at once, so this also limits the output handled
+# in one pass. While the queue is full, the shell blocks on a full pty.
+pty_batch_size = 1 << 18
+
+# Warn about the first undecodable sequence and every this many after it.
+# Output that is not UTF-8 can contain an error for every high byte, and
+# printing a warning for each costs more than decoding them.
+decode_warn_interval = 1000
+
 _initial_profile = r'''
 # Read the standard profile, to give a familiar environment.  The profile can
 # detect that it is in GidTerm using the `TERM_PROGRAM` environment variable.
@@ -77,18 +102,18 @@ GIDTERM_CONFIG="%s"
 export RIPGREP_CONFIG_PATH=${GIDTERM_CONFIG}/ripgrep
 ''' % (terminal_cols, terminal_rows, config_dir)
 
+# Most terminals use the default profile, so only encode it once.
+_initial_profile_bytes = _initial_profile.encode('utf-8')
 
-_exit_status_info = {}  # type: dict[str, str]
 
-for name in dir(signal):
-    if name.startswith('SIG') and not name.startswith('SIG_'):
-        if name in ('SIGRTMIN', 'SIGRTMAX'):
-            continue
-        try:
-            signum = int(getattr(signal, name))
-        except Exception:
-            pass
-        _exit_status_info[str(signum + 128)] = '\U0001f5f2' + name
+# Names are sorted so that, for aliases of the same signal, the result
+# matches across runs.
+_exit_status_info = {
+    str(signum + 128): '\U0001f5f2' + name
+    for name, signum in sorted(vars(signal).items())
+    if name.startswith('SIG') and not name.startswith('SIG_')
+    and name not in ('SIGRTMIN', 'SIGRTMAX')
+}  # type: dict[str, str]
 
 
 def warn(message):
@@ -108,14 +133,17 @@ ELLIPSIS = '\u2025'
 LONG_ELLIPSIS = '\u2026'
 
 
-def _get_package_location(winvar):
-    # type: (dict[str, str]) -> str
-    packages = winvar['packages']
+@functools.lru_cache(maxsize=4)
+def _get_color_scheme(packages):
+    # type: (str) -> str
+    # The packages directory only changes if the user reconfigures Sublime
+    # Text, so the scheme path is calculated once per directory.
     this_package = os.path.dirname(__file__)
     assert this_package.startswith(packages)
     unwanted = os.path.dirname(packages)
     # add one to remove pathname delimiter /
-    return this_package[len(unwanted) + 1:]
+    package = this_package[len(unwanted) + 1:]
+    return os.path.join(package, 'gidterm.sublime-color-scheme')
 
 
 panel_cache = {}  # type: dict[int, DisplayPanel|LivePanel]
@@ -152,32 +180,215 @@ def get_display_panel(view):
     return panel
 
 
+# Windows-1252 characters for each byte, with a replacement character for
+# the few bytes it does not define.
+_cp1252_chars = bytes(range(256)).decode('windows-1252', 'replace')
+
+# Count of output sequences that could not be decoded as UTF-8
+_decode_errors = itertools.count()
+
+
 def gidterm_decode_error(e):
     # type: (...) -> tuple[str, int]
     # If text is not Unicode, it is most likely Latin-1. Windows-1252 is a
     # superset of Latin-1 and may be present in downloaded files.
     # TODO: Use the LANG setting to select appropriate fallback encoding
     b = e.object[e.start:e.end]
-    try:
-        s = b.decode('windows-1252')
-    except UnicodeDecodeError:
-        # If even that can't decode, fallback to using Unicode replacement char
-        s = b.decode('utf8', 'replace')
-    warn('{}: replacing {!r} with {!r}'.format(e.reason, b, s.encode('utf8')))
+    if len(b) == 1:
+        # the usual case, a single high byte
+        s = _cp1252_chars[b[0]]
+    else:
+        try:
+            s = b.decode('windows-1252')
+        except UnicodeDecodeError:
+            # If even that can't decode, fallback to using Unicode replacement char
+            s = b.decode('utf8', 'replace')
+    n = next(_decode_errors)
+    if n % decode_warn_interval == 0:
+        warn('{}: replacing {!r} with {!r} ({} undecodable sequences)'.format(
+            e.reason, b, s.encode('utf8'), n + 1
+        ))
     return s, e.end
 
 
 codecs.register_error('gidterm', gidterm_decode_error)
 
 
+def utf8_complete(data):
+    # type: (bytes) -> int
+    # Return the length of `data` excluding any incomplete UTF-8 character at
+    # the end. A character is at most 4 bytes, so check the last 3 bytes for
+    # the start of a character that needs more bytes than remain.
+    end = len(data)
+    for i in range(end - 1, max(end - 4, -1), -1):
+        b = data[i]
+        if b & 0xc0 != 0x80:
+            if b >= 0xf0:
+                size = 4
+            elif b >= 0xe0:
+                size = 3
+            elif b >= 0xc0:
+                size = 2
+            else:
+                size = 1
+            if i + size > end:
+                return i
+            break
+    return end
+
+
+class TerminalReader:
+    # Read and decode terminal output on a separate thread, so the UI thread
+    # only needs to take the output that has arrived. The thread does not
+    # refer to the Terminal, allowing the Terminal to be garbage collected.
+
+    def __init__(self, fd):
+        # type: (int) -> None
+        self.fd = fd
+        # bytes of an incomplete UTF-8 character from the previous read
+        self.undecoded = b''
+        self.condition = threading.Condition()
+        # The following are protected by `condition`
+        self.output = deque()  # type: deque[str]
+        self.size = 0
+        self.closed = False
+        self.stopping = False
+        self.callback = None  # type: Callable[[], None]|None
+        # Writing to this pipe wakes the thread from `select` to stop it.
+        self.stop_fd, self.stop_wfd = os.pipe()
+        # Before Python 3.4, pipes are inherited, so prevent shells started
+        # later from holding this terminal's pipe open.
+        for pipe_fd in (self.stop_fd, self.stop_wfd):
+            state = fcntl.fcntl(pipe_fd, fcntl.F_GETFD)
+            fcntl.fcntl(pipe_fd, fcntl.F_SETFD, state | fcntl.FD_CLOEXEC)
+        self.thread = threading.Thread(
+            target=self.run, name='gidterm-reader', daemon=True
+        )
+        self.thread.start()
+
+    def run(self):
+        # type: () -> None
+        fd = self.fd
+        stop_fd = self.stop_fd
+        while True:
+            try:
+                rfds, wfds, xfds = select((fd, stop_fd), (), ())
+            except OSError:
+                # the descriptors were closed by `stop` on this thread
+                return
+            if stop_fd in rfds:
+                return
+            try:
+                text = self.read()
+            except OSError as e:
+                if self.stopping:
+                    # the terminal was closed by `stop` on this thread
+                    return
+                # Treat an unexpected read error as the end of output, so the
+                # panel shows the terminal as closed instead of waiting.
+                warn('terminal read failed: {}'.format(e))
+                text = None
+            with self.condition:
+                if text is None:
+                    self.closed = True
+                elif text:
+                    self.output.append(text)
+                    self.size += len(text)
+                callback = None
+                if self.output or self.closed:
+                    callback = self.callback
+                    self.callback = None
+            if callback is not None:
+                callback()
+            with self.condition:
+                while self.size >= pty_batch_size and not self.stopping:
+                    self.condition.wait()
+                if self.closed or self.stopping:
+                    return
+
+    def read(self):
+        # type: () -> str|None
+        # Read the available output, or return None at the end of output.
+        fd = self.fd
+        bufs = []  # type: list[bytes]
+        size = 0
+        while size < pty_batch_size:
+            try:
+                buf = os.read(fd, pty_read_size)
+            except BlockingIOError:
+                # no more output available
+                break
+            except OSError as e:
+                if e.errno != errno.EIO:
+                    raise
+                buf = b''
+            if not buf:
+                if bufs:
+                    # return the output so far, and report the end of output
+                    # on the next call
+                    break
+                data = self.undecoded
+                self.undecoded = b''
+                return data.decode('utf8', 'gidterm') or None
+            bufs.append(buf)
+            size += len(buf)
+        # Decoding a whole buffer with `bytes.decode` is faster than using an
+        # incremental decoder, so hold back any incomplete character until
+        # the next read instead.
+        bufs.insert(0, self.undecoded)
+        data = b''.join(bufs)
+        end = utf8_complete(data)
+        self.undecoded = data[end:]
+        return data[:end].decode('utf8', 'gidterm')
+
+    def stop(self):
+        # type: () -> None
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if threading.current_thread() is not self.thread:
+            os.write(self.stop_wfd, b'x')
+            self.thread.join()
+        # Otherwise, the garbage collector finalized the Terminal on the
+        # reader thread, which cannot join itself. The thread sees
+        # `stopping` and returns once this call completes.
+        os.close(self.stop_fd)
+        os.close(self.stop_wfd)
+
+    def notify(self, callback):
+        # type: (Callable[[], None]) -> None
+        # Call `callback` once, when output is available. This may be called
+        # immediately, or later from the reader thread.
+        with self.condition:
+            if not (self.output or self.closed):
+                self.callback = callback
+                return
+        callback()
+
+    def ready(self):
+        # type: () -> bool
+        with self.condition:
+            return bool(self.output) or self.closed
+
+    def receive(self):
+        # type: () -> str|None
+        with self.condition:
+            output = self.output
+            if not output:
+                return None if self.closed else ''
+            self.output = deque()
+            self.size = 0
+            self.condition.notify_all()
+        return ''.join(output)
+
+
 class Terminal:
 
     def __init__(self):
         # type: () -> None
         self.pid = None  # type: int|None
         self.fd = None  # type: int|None
-        utf8_decoder_factory = codecs.getincrementaldecoder('utf8')
-        self.decoder = utf8_decoder_factory(errors='gidterm')
+        self.reader = None  # type: TerminalReader|None
 
     def __del__(self):
         # type: () -> None
@@ -221,9 +432,18 @@ class Terminal:
             # terminating the shell.
             state = fcntl.fcntl(self.fd, fcntl.F_GETFD)
             fcntl.fcntl(self.fd, fcntl.F_SETFD, state | fcntl.FD_CLOEXEC)
+            # Make reads return immediately when no output is available,
+            # allowing the reader to drain the output without a `select`
+            # before each read.
+            state = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, state | os.O_NONBLOCK)
+            self.reader = TerminalReader(self.fd)
 
     def stop(self):
         # type: () -> None
+        if self.reader is not None:
+            self.reader.stop()
+            self.reader = None
         if self.fd is not None:
             os.close(self.fd)
             self.fd = None
@@ -237,46 +457,146 @@ class Terminal:
         if self.fd is None:
             return False
         if s:
-            os.write(self.fd, s.encode('utf8'))
+            data = memoryview(s.encode('utf8'))
+            while data:
+                try:
+                    n = os.write(self.fd, data)
+                except BlockingIOError:
+                    # input buffer is full, wait for the shell to read some
+                    select((), (self.fd,), ())
+                else:
+                    data = data[n:]
         return True
 
     def ready(self):
         # type: () -> bool
-        fd = self.fd
-        if fd is None:
+        reader = self.reader
+        if reader is None:
             return True
-        rfds, wfds, xfds = select((fd,), (), (), 0)
-        return fd in rfds
+        return reader.ready()
+
+    def notify(self, callback):
+        # type: (Callable[[], None]) -> None
+        reader = self.reader
+        if reader is None:
+            callback()
+        else:
+            reader.notify(callback)
 
     def receive(self):
-        # type: () -> str
-        fd = self.fd
-        if fd is None:
-            return ''
-        try:
-            buf = os.read(fd, 2048)
-        except OSError as e:
-            if e.errno == errno.EIO:
-                return self.decoder.decode(b'', final=True)
-            raise
-        return self.decoder.decode(buf, final=not buf)
+        # type: () -> str|None
+        # Return the available output, which may be empty, or None if the
+        # terminal has closed its output.
+        reader = self.reader
+        if reader is None:
+            return None
+        return reader.receive()
+
+
+# Scope color names for SGR codes 30-37 (foreground) and 40-47 (background),
+# with 90-97 and 100-107 selecting the bright versions.
+_sgr_base_colors = (
+    'black', 'red', 'green', 'yellow', 'blue', 'cyan', 'magenta', 'white'
+)
+
+# The effect of each single-number SGR code, as a (foreground, background)
+# pair, where None leaves that color unchanged. This allows each code to be
+# handled with a single lookup.
+_sgr_codes = {
+    '0': ('default', 'default'),
+    '00': ('default', 'default'),
+    '39': ('default', None),
+    '49': (None, 'default'),
+}  # type: dict[str, tuple[str|None, str|None]]
+
+for index, color in enumerate(_sgr_base_colors):
+    _sgr_codes[str(30 + index)] = (color, None)
+    _sgr_codes[str(90 + index)] = ('bright' + color, None)
+    _sgr_codes[str(40 + index)] = (None, color)
+    _sgr_codes[str(100 + index)] = (None, 'bright' + color)
+
+# TODO: handle bold/faint intensity (1, 2, 22) and fonts (10-19)
+for code in ['1', '01', '2', '02', '22'] + [str(n) for n in range(10, 20)]:
+    _sgr_codes[code] = (None, None)
+
+
+def _sgr_8bit_color(idx):
+    # type: (int) -> str
+    # Approximate an 8-bit color using the 16 standard colors
+    if idx < 8:
+        return _sgr_base_colors[idx]
+    elif idx < 16:
+        return 'bright' + _sgr_base_colors[idx - 8]
+    elif idx >= 254:
+        return 'brightwhite'  # mostly white
+    elif idx >= 247:
+        return 'white'  # light grey
+    elif idx >= 240:
+        return 'brightblack'  # dark grey
+    elif idx >= 232:
+        return 'black'  # mostly black
+    rg, b = divmod(idx - 16, 6)
+    r, g = divmod(rg, 6)
+    r //= 3
+    g //= 3
+    b //= 3
+    if r and g and b:
+        return 'white'
+    return 'bright' + _sgr_base_colors[r + 2 * g + 4 * b]
+
+
+_sgr_8bit_colors = tuple(_sgr_8bit_color(idx) for idx in range(256))
+
+
+def _sgr_24bit_color(r, g, b):
+    # type: (int, int, int) -> str
+    # Approximate a 24-bit color using the nearest color in the 6x6x6 cube of
+    # 8-bit colors
+    r, g, b = ((min(c, 255) * 5 + 127) // 255 for c in (r, g, b))
+    return _sgr_8bit_colors[16 + 36 * r + 6 * g + b]
+
+
+# The scope for each (foreground, background) pair, with no scope for the
+# default colors.
+_sgr_colors = _sgr_base_colors + tuple('bright' + color for color in _sgr_base_colors) + ('default',)
+_sgr_scopes = {
+    (fg, bg): 'sgr.{}-on-{}'.format(fg, bg) for fg in _sgr_colors for bg in _sgr_colors
+}  # type: dict[tuple[str, str], str]
+_sgr_scopes['default', 'default'] = ''
+
+# Values of the most common CSI numeric arguments, to avoid calling int()
+_csi_small_ints = {str(n): n for n in range(100)}  # type: dict[str, int]
+
+
+def _csi_count(arg):
+    # type: (str) -> int
+    # A CSI repeat count defaults to 1 if omitted
+    if not arg:
+        return 1
+    n = _csi_small_ints.get(arg)
+    if n is None:
+        n = int(arg)
+    return n
 
 
 class TerminalOutput:
 
     # Pattern to match control characters from the terminal that
-    # need to be handled specially.
+    # need to be handled specially. The name of the matching group
+    # selects the handler. The leading lookahead lets the regex engine
+    # skip quickly over ordinary text to the next possible match.
     _escape_pat = re.compile(
-        r'('
-        r'\x07|'                                        # BEL
-        r'\x08+|'                                       # BACKSPACE's
-        r'\r+|'                                         # CR's
-        r'\n|'                                          # NL
-        r'\x1b(?:'                                      # Escapes:
-        r'[()*+]B|'                                     # - codeset
-        r'\]0;.*?(?:\x07|\x1b\\)|'                      # - set title
-        r'\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]'        # - CSI
-        r'))'
+        r'(?=[\x07\x08\r\n\x1b])(?:'                      # Any of:
+        r'(?P<bell>\x07)|'                                # BEL
+        r'(?P<backspace>\x08+)|'                          # BACKSPACE's
+        r'(?P<cr>\r+)|'                                   # CR's
+        r'(?P<nl>\n)|'                                    # NL
+        r'(?P<prompt>\x1b\[[\x30-\x3f]*[\x20-\x2f]*p)|'   # GidTerm prompt
+        r'(?P<escape>\x1b(?:'                             # Escapes:
+        r'[()*+]B|'                                       # - codeset
+        r'\]0;.*?(?:\x07|\x1b\\)|'                        # - set title
+        r'\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e]'          # - CSI
+        r')))'
     )
 
     # Pattern to match the prefix of above. If it occurs at the end of
@@ -307,24 +627,35 @@ class TerminalOutput:
     Delete = namedtuple('Delete', 'n')
     SelectGraphicRendition = namedtuple('SelectGraphicRendition', ('foreground', 'background'))
 
+    # CSI commands taking a single repeat count, mapped to their event
+    _csi_counted = {
+        '@': Insert,
+        'A': CursorUp,
+        'B': CursorDown,
+        'C': CursorRight,
+        'D': CursorLeft,
+        'P': Delete,
+    }
+
     def __init__(self, terminal):
         # type: (Terminal) -> None
         self.saved = ''
         self.prompt_text = ''
         self.in_prompt = None  # type: str|None
 
-        self._csi_map = {
-            '@': self.handle_insert,
-            'A': self.handle_cursor_up,
-            'B': self.handle_cursor_down,
-            'C': self.handle_cursor_right,
-            'D': self.handle_cursor_left,
-            'H': self.handle_cursor_moveto,
-            'K': self.handle_clear_line,
-            'P': self.handle_delete,
-            'f': self.handle_cursor_moveto,
-            'm': self.handle_rendition,
+        self._control_map = {
+            'bell': self.handle_bell,
+            'backspace': self.handle_backspace,
+            'cr': self.handle_carriage_return,
+            'nl': self.handle_line_feed,
+            'escape': self.handle_escape,
         }
+        # The text of PS1 is scanned after the prompt markers have been
+        # removed, so treat anything resembling one as an ordinary escape.
+        self._prompt_control_map = dict(self._control_map, prompt=self.handle_escape)
+        # The same prompt is displayed repeatedly, so keep the events for
+        # recent prompts rather than scanning each one again.
+        self._prompt_events = functools.lru_cache(maxsize=32)(self._scan_prompt)
 
         self.iterator = self.loop(terminal)
 
@@ -336,50 +667,67 @@ class TerminalOutput:
         while terminal:
             if terminal.ready():
                 s = terminal.receive()
-                if s:
-                    yield from self.handle_output(s)
-                else:
+                if s is None:
                     # terminal closed output channel
                     terminal = None
+                elif s:
+                    yield from self.handle_output(s)
             else:
                 yield TerminalOutput.NotReady()
 
     def handle_output(self, text):
         # (str) -> Iterator[namedtuple]
-        # Add any saved text from previous iteration, split text on control
+        # Add any saved text from previous iteration, scan text for control
         # characters that are handled specially, then save any partial control
-        # characters at end of text.
+        # characters at end of text.  Most control handlers return a single
+        # event (or None), avoiding a generator for each control sequence.
+        # Text is only yielded before another event, so text either side of
+        # an ignored control sequence is yielded as one event.
         text = self.saved + text
-        parts = self._escape_pat.split(text)
-        last = parts[-1]
-        match = self._partial_pat.search(last)
-        if match:
-            i = match.start()
-            parts[-1], self.saved = last[:i], last[i:]
-        else:
-            self.saved = ''
-        # Loop over alternating plain and control items
-        plain = False
-        for part in parts:
-            plain = not plain
+        control_map = self._control_map
+        pending = ''
+        pos = 0
+        for match in self._escape_pat.finditer(text):
+            start = match.start()
+            part = match.group()
             if self.in_prompt is None:
-                if plain:
-                    if part:
-                        yield TerminalOutput.Text(part)
+                pending += text[pos:start]
+                kind = match.lastgroup
+                if kind == 'prompt':
+                    if pending:
+                        yield TerminalOutput.Text(pending)
+                        pending = ''
+                    yield from self.handle_prompt(part)
                 else:
-                    if part[0] == '\x1b':
-                        command = part[-1]
-                        if command == 'p':
-                            yield from self.handle_prompt(part)
-                        else:
-                            yield from self.handle_escape(part)
-                    else:
-                        yield from self.handle_control(part)
+                    event = control_map[kind](part)
+                    if event is not None:
+                        if pending:
+                            yield TerminalOutput.Text(pending)
+                            pending = ''
+                        yield event
+            elif part == '\x1b[~':
+                self.prompt_text += text[pos:start]
+                yield from self.handle_prompt_end(part)
             else:
-                if not plain and part == '\x1b[~':
-                    yield from self.handle_prompt_end(part)
-                else:
-                    self.prompt_text += part
+                self.prompt_text += text[pos:match.end()]
+            pos = match.end()
+        # A partial escape starts with ESC, so only search from the first
+        # ESC, and not at all for the common case of a tail without one. The
+        # search cannot be limited to the last few characters, as a partial
+        # set-title escape can be any length.
+        end = len(text)
+        i = text.find('\x1b', pos)
+        if i >= 0:
+            match = self._partial_pat.search(text, i)
+            if match:
+                end = match.start()
+        self.saved = text[end:]
+        if self.in_prompt is None:
+            pending += text[pos:end]
+            if pending:
+                yield TerminalOutput.Text(pending)
+        elif end > pos:
+            self.prompt_text += text[pos:end]
 
     def handle_prompt(self, part):
         # (str) -> Iterator[namedtuple]
@@ -409,97 +757,67 @@ class TerminalOutput:
         else:
             assert self.in_prompt == '5', self.in_prompt
             yield TerminalOutput.Prompt1Starts()
-            ps1 = self.prompt_text
-            parts = self._escape_pat.split(ps1)
-            plain = False
-            for part in parts:
-                plain = not plain
-                if plain:
-                    if part:
-                        yield TerminalOutput.Text(part)
-                else:
-                    if part[0] == '\x1b':
-                        yield from self.handle_escape(part)
-                    else:
-                        yield from self.handle_control(part)
+            yield from self._prompt_events(self.prompt_text)
             yield TerminalOutput.Prompt1Stops()
 
         self.in_prompt = None
         self.prompt_text = ''
 
-    def handle_control(self, part):
-        # (str) -> Iterator[namedtuple]
-        if part == '\x07':
-            return
-        if part[0] == '\x08':
-            n = len(part)
-            yield TerminalOutput.CursorLeft(n)
-            return
-        if part[0] == '\r':
-            # move cursor to start of line
-            n = len(part)
-            yield TerminalOutput.CursorReturn(n)
-            return
-        if part == '\n':
-            yield TerminalOutput.LineFeed()
-            return
-        warn('unknown control: {!r}'.format(part))
+    def _scan_prompt(self, ps1):
+        # type: (str) -> tuple[namedtuple, ...]
+        control_map = self._prompt_control_map
+        events = []
+        pending = ''
+        pos = 0
+        for match in self._escape_pat.finditer(ps1):
+            pending += ps1[pos:match.start()]
+            event = control_map[match.lastgroup](match.group())
+            if event is not None:
+                if pending:
+                    events.append(TerminalOutput.Text(pending))
+                    pending = ''
+                events.append(event)
+            pos = match.end()
+        pending += ps1[pos:]
+        if pending:
+            events.append(TerminalOutput.Text(pending))
+        return tuple(events)
+
+    def handle_bell(self, part):
+        # (str) -> namedtuple|None
+        return None
+
+    def handle_backspace(self, part):
+        # (str) -> namedtuple|None
+        return TerminalOutput.CursorLeft(len(part))
+
+    def handle_carriage_return(self, part):
+        # (str) -> namedtuple|None
+        # move cursor to start of line
+        return TerminalOutput.CursorReturn(len(part))
+
+    def handle_line_feed(self, part):
+        # (str) -> namedtuple|None
+        return TerminalOutput.LineFeed()
 
     def handle_escape(self, part):
-        # (str) -> Iterator[namedtuple]
+        # (str) -> namedtuple|None
         if part[1] != '[':
             assert part[1] in '()*+]', part
             # ignore codeset and set-title
-            return
+            return None
         command = part[-1]
+        event = self._csi_counted.get(command)
+        if event is not None:
+            return event(_csi_count(part[2:-1]))
         method = self._csi_map.get(command)
         if method is None:
             warn('Unhandled escape code: {!r}'.format(part))
-        else:
-            yield from method(part[2:-1])
-
-    def handle_insert(self, arg):
-        # (str) -> Iterator[namedtuple]
-        if arg:
-            n = int(arg)
-        else:
-            n = 1
-        yield TerminalOutput.Insert(n)
-
-    def handle_cursor_up(self, arg):
-        # (str) -> Iterator[namedtuple]
-        if arg:
-            n = int(arg)
-        else:
-            n = 1
-        yield TerminalOutput.CursorUp(n)
-
-    def handle_cursor_down(self, arg):
-        # (str) -> Iterator[namedtuple]
-        if arg:
-            n = int(arg)
-        else:
-            n = 1
-        yield TerminalOutput.CursorDown(n)
-
-    def handle_cursor_right(self, arg):
-        # (str) -> Iterator[namedtuple]
-        if arg:
-            n = int(arg)
-        else:
-            n = 1
-        yield TerminalOutput.CursorRight(n)
-
-    def handle_cursor_left(self, arg):
-        # (str) -> Iterator[namedtuple]
-        if arg:
-            n = int(arg)
-        else:
-            n = 1
-        yield TerminalOutput.CursorLeft(n)
+            return None
+        return method(self, part[2:-1])
 
     def handle_cursor_moveto(self, arg):
-        # (str) -> Iterator[namedtuple]
+        # (str) -> namedtuple|None
         if not arg:
             row = 0
             col = 0
@@ -510,263 +828,191 @@ class TerminalOutput:
         else:
             row = int(arg) - 1
             col = 0
-        yield TerminalOutput.CursorMoveTo(row, col)
+        return TerminalOutput.CursorMoveTo(row, col)
 
     def handle_clear_line(self, arg):
-        # (str) -> Iterator[namedtuple]
+        # (str) -> namedtuple|None
         if not arg or arg == '0':
             # clear to end of line
-            yield TerminalOutput.ClearToEndOfLine()
+            return TerminalOutput.ClearToEndOfLine()
         elif arg == '1':
             # clear to start of line
-            yield TerminalOutput.ClearToStartOfLine()
+            return TerminalOutput.ClearToStartOfLine()
         elif arg == '2':
             # clear line
-            yield TerminalOutput.ClearLine()
-
-    def handle_delete(self, arg):
-        # (str) -> Iterator[namedtuple]
-        n = int(arg)
-        yield TerminalOutput.Delete(n)
+            return TerminalOutput.ClearLine()
+        return None
 
     def handle_rendition(self, arg):
-        # (str) -> Iterator[namedtuple]
+        # (str) -> namedtuple|None
         if not arg:
             # ESC[m -> default
-            yield TerminalOutput.SelectGraphicRendition('default', 'default')
-            return
+            return TerminalOutput.SelectGraphicRendition('default', 'default')
         fg = 'default'
         bg = 'default'
         nums = arg.split(';')
         i = 0
         while i < len(nums):
             num = nums[i]
-            if num in ('0', '00'):
-                fg = 'default'
-                bg = 'default'
-            elif num in ('1', '01', '2', '02', '22'):
-                # TODO: handle bold/faint intensity
-                pass
-            elif num.startswith('1') and len(num) == 2:
-                # TODO: handle these
-                pass
-            elif num == '30':
-                fg = 'black'
-            elif num == '31':
-                fg = 'red'
-            elif num == '32':
-                fg = 'green'
-            elif num == '33':
-                fg = 'yellow'
-            elif num == '34':
-                fg = 'blue'
-            elif num == '35':
-                fg = 'cyan'
-            elif num == '36':
-                fg = 'magenta'
-            elif num == '37':
-                fg = 'white'
-            elif num == '38':
-                i += 1
-                selector = nums[i]
-                if selector == '2':
-                    # r, g, b
-                    i += 3
-                    continue
-                elif selector == '5':
-                    # 8-bit
-                    idx = int(nums[i + 1])
-                    if idx < 8:
-                        nums[i + 1] = str(30 + idx)
-                    elif idx < 16:
-                        nums[i + 1] = str(90 + idx - 8)
-                    elif idx >= 254:
-                        nums[i + 1] = '97'  # mostly white
-                    elif idx >= 247:
-                        nums[i + 1] = '37'   # light grey
-                    elif idx >= 240:
-                        nums[i + 1] = '90'   # dark grey
-                    elif idx >= 232:
-                        nums[i + 1] = '30'   # mostly black
-                    else:
-                        assert 16 <= idx <= 231, idx
-                        rg, b = divmod(idx - 16, 6)
-                        r, g = divmod(rg, 6)
-                        r //= 3
-                        g //= 3
-                        b //= 3
-                        x = {
-                            (0, 0, 0): '90',
-                            (0, 0, 1): '94',
-                            (0, 1, 0): '92',
-                            (0, 1, 1): '96',
-                            (1, 0, 0): '91',
-                            (1, 0, 1): '95',
-                            (1, 1, 0): '93',
-                            (1, 1, 1): '37',
-                        }
-                        nums[i + 1] = x[(r, g, b)]
-            elif num == '39':
-                fg = 'default'
-            elif num == '40':
-                bg = 'black'
-            elif num == '41':
-                bg = 'red'
-            elif num == '42':
-                bg = 'green'
-            elif num == '43':
-                bg = 'yellow'
-            elif num == '44':
-                bg = 'blue'
-            elif num == '45':
-                bg = 'cyan'
-            elif num == '46':
-                bg = 'magenta'
-            elif num == '47':
-                bg = 'white'
-            elif num == '48':
-                i += 1
+            i += 1
+            effect = _sgr_codes.get(num)
+            if effect is not None:
+                if effect[0] is not None:
+                    fg = effect[0]
+                if effect[1] is not None:
+                    bg = effect[1]
+            elif num in ('38', '48') and i < len(nums):
                 selector = nums[i]
-                if selector == '2':
-                    # r, g, b
-                    i += 3
-                elif selector == '5':
+                if selector == '5':
                     # 8-bit
-                    idx = int(nums[i + 1])
-                    if idx < 8:
-                        nums[i + 1] = str(40 + idx)
-                    elif idx < 16:
-                        nums[i + 1] = str(100 + idx - 8)
-                    elif idx >= 254:
-                        nums[i + 1] = '107'  # mostly white
-                    elif idx >= 247:
-                        nums[i + 1] = '47'   # light grey
-                    elif idx >= 240:
-                        nums[i + 1] = '100'   # dark grey
-                    elif idx >= 232:
-                        nums[i + 1] = '40'   # mostly black
-                    else:
-                        assert 16 <= idx <= 231, idx
-                        rg, b = divmod(idx - 16, 6)
-                        r, g = divmod(rg, 6)
-                        r //= 3
-                        g //= 3
-                        b //= 3
-                        x = {
-                            (0, 0, 0): '100',
-                            (0, 0, 1): '104',
-                            (0, 1, 0): '102',
-                            (0, 1, 1): '106',
-                            (1, 0, 0): '101',
-                            (1, 0, 1): '105',
-                            (1, 1, 0): '103',
-                            (1, 1, 1): '47',
-                        }
-                        nums[i + 1] = x[(r, g, b)]
-            elif num == '49':
-                bg = 'default'
-            elif num == '90':
-                fg = 'brightblack'
-            elif num == '91':
-                fg = 'brightred'
-            elif num == '92':
-                fg = 'brightgreen'
-            elif num == '93':
-                fg = 'brightyellow'
-            elif num == '94':
-                fg = 'brightblue'
-            elif num == '95':
-                fg = 'brightcyan'
-            elif num == '96':
-                fg = 'brightmagenta'
-            elif num == '97':
-                fg = 'brightwhite'
-            elif num == '100':
-                bg = 'brightblack'
-            elif num == '101':
-                bg = 'brightred'
-            elif num == '102':
-                bg = 'brightgreen'
-            elif num == '103':
-                bg = 'brightyellow'
-            elif num == '104':
-                bg = 'brightblue'
-            elif num == '105':
-                bg = 'brightcyan'
-            elif num == '106':
-                bg = 'brightmagenta'
-            elif num == '107':
-                bg = 'brightwhite'
+                    size = 1
+                elif selector == '2':
+                    # 24-bit, as 2;r;g;b
+                    size = 3
+                else:
+                    warn('Unhandled SGR code: {} in {}'.format(num, arg))
+                    continue
+                values = nums[i + 1:i + 1 + size]
+                i += 1 + size
+                if len(values) < size:
+                    # too few values
+                    continue
+                try:
+                    # omitted values default to 0
+                    numbers = [int(n or 0) for n in values]
+                except ValueError:
+                    warn('Invalid SGR color: {} in {}'.format(num, arg))
+                    continue
+                if size == 1:
+                    color = _sgr_8bit_colors[min(numbers[0], 255)]
+                else:
+                    color = _sgr_24bit_color(*numbers)
+                if num == '38':
+                    fg = color
+                else:
+                    bg = color
             else:
                 warn('Unhandled SGR code: {} in {}'.format(num, arg))
-            i += 1
-        yield TerminalOutput.SelectGraphicRendition(fg, bg)
+        return TerminalOutput.SelectGraphicRendition(fg, bg)
+
+    # Handlers for other CSI commands. These are the plain functions, shared
+    # by all instances, so they are called with `self` as first argument.
+    _csi_map = {
+        'H': handle_cursor_moveto,
+        'K': handle_clear_line,
+        'f': handle_cursor_moveto,
+        'm': handle_rendition,
+    }
 
 class CommandHistory:
 
     def __init__(self, view):
         # type: (sublime.View) -> None
         self.settings = view.settings()
+        self.dirty = False
         self.load()
 
     def load(self):
         # type: () -> None
-        # Settings allow None, bool, int, float, str, dict, list (with tuples
-        # converted to lists).
-        # list[int] is a Region(begin, end) using above types
-        # next list is multiple Region's for a multi-line command
-        # next list is each command
-        self.commands = self.settings.get('gidterm_command_history', [])  # type: list[list[list[int]]]
+        # The regions of all commands are kept in flat arrays of integers.
+        # `spans` holds the begin and end of each region, with the regions
+        # of command `i` at `spans[offsets[i]:offsets[i + 1]]`. `starts`
+        # and `ends` hold the begin of the first region and the end of the
+        # last region of each command, for searching.
+        self.starts = array('q')
+        self.ends = array('q')
+        self.offsets = array('q', [0])
+        self.spans = array('q')
+        saved = self.settings.get('gidterm_command_regions')
+        if saved is None:
+            # Older versions saved a list of commands, each a list of
+            # [begin, end] regions.
+            for command in self.settings.get('gidterm_command_history', []):
+                self.add([n for region in command for n in region])
+        else:
+            self.offsets = array('q', saved['offsets'])
+            self.spans = array('q', saved['spans'])
+            spans = self.spans
+            offsets = self.offsets
+            for i in range(len(offsets) - 1):
+                self.starts.append(spans[offsets[i]])
+                self.ends.append(spans[offsets[i + 1] - 1])
 
     def save(self):
         # type: () -> None
-        self.settings.set('gidterm_command_history', self.commands)
+        # Settings allow None, bool, int, float, str, dict, list (with tuples
+        # converted to lists).
+        self.settings.set('gidterm_command_regions', {
+            'offsets': self.offsets.tolist(),
+            'spans': self.spans.tolist(),
+        })
+        self.settings.erase('gidterm_command_history')
+
+    def add(self, spans):
+        # type: (list[int]) -> None
+        self.starts.append(spans[0])
+        self.ends.append(spans[-1])
+        self.spans.extend(spans)
+        self.offsets.append(len(self.spans))
 
     def append(self, regions, offset):
         # type: (list[sublime.Region], int) -> None
-        command = [[r.begin() + offset, r.end() + offset] for r in regions]
-        self.commands.append(command)
-        self.save()
+        spans = []  # type: list[int]
+        for r in regions:
+            spans.append(r.begin() + offset)
+            spans.append(r.end() + offset)
+        self.add(spans)
+        if not self.dirty:
+            # Writing the settings copies the whole history, so save once
+            # for a run of commands rather than after each one.
+            self.dirty = True
+            sublime.set_timeout(self.flush, 250)
+
+    def flush(self):
+        # type: () -> None
+        if self.dirty:
+            self.dirty = False
+            self.save()
 
     def regions(self, index):
         # type: (int) -> list[sublime.Region]
-        return [sublime.Region(c[0], c[1]) for c in self.commands[index]]
+        spans = self.spans
+        return [
+            sublime.Region(spans[i], spans[i + 1])
+            for i in range(self.offsets[index], self.offsets[index + 1], 2)
+        ]
 
     def first_command_before(self, pos):
         # type: (int) -> list[sublime.Region]|None
-        commands = self.commands
-        low = 0
-        if not commands or commands[0][-1][1] > pos:
+        # last command ending at or before pos
+        index = bisect_right(self.ends, pos) - 1
+        if index < 0:
             return None
-        # low is a known valid object and high is index before the first known invalid object
-        high = len(commands) - 1
-        while high > low:
-            index = low + 1 + (high - low) // 2
-            command = self.commands[index]
-            if command[-1][1] <= pos:
-                low = index
-            else:
-                high = index - 1
-
-        return self.regions(low)
+        return self.regions(index)
 
     def first_command_after(self, pos):
         # type: (int) -> list[sublime.Region]|None
-        commands = self.commands
-        low = 0
-        if not commands or commands[-1][0][0] < pos:
+        # first command starting at or after pos
+        index = bisect_left(self.starts, pos)
+        if index == len(self.starts):
             return None
-        high = len(self.commands) - 1
-        # high is a known valid object and low is index after the first known invalid object
-        while high > low:
-            index = low + (high - low) // 2
-            command = self.commands[index]
-            if command[0][0] >= pos:
-                high = index
-            else:
-                low = index + 1
+        return self.regions(index)
+
+
+# Convert text to HTML in a single pass, keeping spaces from collapsing
+_preview_escapes = str.maketrans({
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    ' ': '&nbsp;',
+    '\n': '<br>',
+})
 
-        return self.regions(low)
+# HTML surrounding the preview text
+_preview_prefix = '<body><style>div {background-color: #80808040;}</style><div>'
+_preview_suffix = '</div></body>'
+# Spaces to keep an inline preview as wide as the terminal background
+_preview_pad = '&nbsp;' * 240
 
 
 class DisplayPanel:
@@ -788,6 +1034,8 @@ class DisplayPanel:
         self.set_tab_label('gidterm starting\u2026')
 
         self.preview_phantoms = sublime.PhantomSet(view, 'preview')
+        # The arguments of the last preview, to skip updates that change nothing
+        self._previewed = None  # type: tuple[str, int, int]|None
 
         self.live_panel = LivePanel(
             self,
@@ -810,6 +1058,7 @@ class DisplayPanel:
 
     def close(self):
         # type: () -> None
+        self.command_history.flush()
         panel_name = self.live_panel_name()
         window = sublime.active_window()
         live_view = window.find_output_panel(panel_name)
@@ -859,7 +1108,7 @@ class DisplayPanel:
             if text_begin == 0:
                 self.view.run_command('gidterm_cursor', {'position': text_end})
             for scope, new_regions in scopes.items():
-                regions = self.view.get_regions(scope)
+                appended = []  # type: list[sublime.Region]
                 for new_region in new_regions:
                     # shift region to where text was appended
                     begin = text_begin + new_region.begin()
@@ -869,13 +1118,19 @@ class DisplayPanel:
                         continue
                     if end > text_end:
                         end = text_end
-                    if regions and regions[-1].end() == begin:
+                    if appended and appended[-1].end() == begin:
                         # merge into previous region
-                        prev = regions.pop()
-                        region = sublime.Region(prev.begin(), end)
-                    else:
-                        region = sublime.Region(begin, end)
-                    regions.append(region)
+                        begin = appended.pop().begin()
+                    appended.append(sublime.Region(begin, end))
+                if not appended:
+                    # nothing to add, so leave the existing regions alone
+                    continue
+                regions = self.view.get_regions(scope)
+                if regions and regions[-1].end() == appended[0].begin():
+                    # merge into last existing region
+                    prev = regions.pop()
+                    appended[0] = sublime.Region(prev.begin(), appended[0].end())
+                regions.extend(appended)
                 self.view.add_regions(
                     scope, regions, scope,
                     flags=sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT
@@ -913,33 +1168,43 @@ class DisplayPanel:
         # type: (list[sublime.Region]) -> None
         self.command_history.append(command_range, self.view.size())
 
-    def add_output(self, text, home, cursor, scopes):
-        # type: (str, int, int, dict[str, list[sublime.Region]]) -> None
-        self.append_text(text[:home], scopes)
-        self.preview(text[home:], cursor)
+    def add_output(self, text, preview, cursor, scopes):
+        # type: (str, str, int, dict[str, list[sublime.Region]]) -> None
+        self.append_text(text, scopes)
+        self.preview(preview, cursor)
 
     def preview(self, text, cursor):
         # type: (str, int) -> None
-        def escape(text):
-            # type: (str) -> str
-            return html.escape(text, quote=False).replace(' ', '&nbsp;')
+        end = self.view.size()
+        previewed = (text, cursor, end)
+        if previewed == self._previewed:
+            return
+        self._previewed = previewed
+        escapes = _preview_escapes
         text = text.rstrip('\n')  # avoid showing extra line for newline
+        lines = text.count('\n') + 1
         if 0 <= cursor <= len(text):
             before = text[:cursor]
             here = text[cursor:cursor + 1] or ' '
             after = text[cursor + 1:]
-            text = '%s<u>%s</u>%s' % (escape(before), escape(here), escape(after))
+            text = '%s<u>%s</u>%s' % (
+                before.translate(escapes),
+                here.translate(escapes),
+                after.translate(escapes),
+            )
         else:
-            text = escape(text)
-        end = self.view.size()
-        parts = text.split('\n')
+            text = text.translate(escapes)
         if end == 0:
             # we use LAYOUT_INLINE which needs extra spaces to keep terminal background wide
-            parts[0] = parts[0] + '&nbsp;' * 240
-        while len(parts) <= terminal_rows:
-            parts.append('')
-        text = '<br>'.join(parts)
-        text = '<body><style>div {background-color: #80808040;}</style><div>%s</div></body>' % text
+            # Any '<' in the text has been escaped, so this finds the first newline.
+            i = text.find('<br>')
+            if i < 0:
+                i = len(text)
+            text = text[:i] + _preview_pad + text[i:]
+        if lines <= terminal_rows:
+            text = _preview_prefix + text + '<br>' * (terminal_rows + 1 - lines) + _preview_suffix
+        else:
+            text = _preview_prefix + text + _preview_suffix
         if end == 0:
             # Initially, use INLINE to keep preview on first line, not after it
             layout = sublime.LAYOUT_INLINE
@@ -989,46 +1254,29 @@ class DisplayPanel:
         self.view.run_command('gidterm_cursor', {'position': self.view.size()})
 
 
-colors = (
-    'black',
-    'red',
-    'green',
-    'yellow',
-    'blue',
-    'magenta',
-    'cyan',
-    'white',
-    'brightblack',
-    'brightred',
-    'brightgreen',
-    'brightyellow',
-    'brightblue',
-    'brightmagenta',
-    'brightcyan',
-    'brightwhite',
-)
-
-
-def get_scopes(view):
-    # type: (sublime.View) -> dict[str, list[sublime.Region]]
-    scopes = {}
-    for foreground in colors:
-        scope = 'sgr.{}-on-default'.format(foreground)
+def get_scopes(view, scopes):
+    # type: (sublime.View, Iterable[str]) -> dict[str, list[sublime.Region]]
+    result = {}
+    for scope in scopes:
         regions = view.get_regions(scope)
         if regions:
-            scopes[scope] = regions
-    for background in colors:
-        scope = 'sgr.default-on-{}'.format(background)
-        regions = view.get_regions(scope)
-        if regions:
-            scopes[scope] = regions
-    for foreground in colors:
-        for background in colors:
-            scope = 'sgr.{}-on-{}'.format(foreground, background)
-            regions = view.get_regions(scope)
-            if regions:
-                scopes[scope] = regions
-    return scopes
+            result[scope] = regions
+    return result
+
+
+@functools.lru_cache(maxsize=16)
+def _path_suffixes(pwd):
+    # type: (str) -> tuple[list[str], list[str], list[int]]
+    # Split a path for shortening in labels. Returns the components, and
+    # the suffixes made of the last component plus 0, 1, 2, ... preceding
+    # components (stopping before the first two), with their lengths. The
+    # label is updated every second while a command runs, but the working
+    # directory rarely changes.
+    parts = pwd.split('/')
+    suffixes = [parts[-1]]
+    for part in reversed(parts[2:-1]):
+        suffixes.append(part + '/' + suffixes[-1])
+    return parts, suffixes, [len(suffix) for suffix in suffixes]
 
 
 class LivePanel:
@@ -1040,6 +1288,8 @@ class LivePanel:
         self.pwd = pwd
         self.init_file = init_file
         self.is_active = False
+        # Number of active `batch` contexts
+        self.batches = 0
         view = self.view = self.reset_view(display_panel, panel_name, pwd)
         settings = view.settings()
         settings.set('current_working_directory', pwd)
@@ -1063,6 +1313,10 @@ class LivePanel:
         self.out_start_time = None  # type: datetime|None
         self.update_running = False
 
+        # Limit the rate of pushes to the display
+        self.push_time = 0.0
+        self.push_pending = False
+
         self.terminal = Terminal()  # type: Terminal|None
         self.terminal.start(self.pwd, self.init_file)
         self.terminal_output = TerminalOutput(self.terminal)
@@ -1119,6 +1373,10 @@ class LivePanel:
                 return pwd + PROMPT
             return ELLIPSIS + PROMPT
 
+        if not command_words and len(pwd) < size:
+            # the usual idle prompt, where the whole path fits
+            return pwd + PROMPT
+
         size -= 1  # for PROMPT
         if command_words:
             arg0 = command_words[0]
@@ -1139,7 +1397,7 @@ class LivePanel:
         else:
             right = ''
 
-        parts = pwd.split('/')
+        parts, suffixes, suffix_lengths = _path_suffixes(pwd)
         if len(parts) >= 3:
             short = '**/{}'.format(parts[-1])
         else:
@@ -1158,20 +1416,15 @@ class LivePanel:
         if len(pwd) <= size:
             left = pwd
         elif len(short) <= size:
-            left = short
+            # add as many components to the end as fit
+            k = bisect_right(suffix_lengths, size - 3) - 1
+            end = suffixes[k]
+            left = '**/{}'.format(end)
             start = parts[:2]
-            end = parts[-1]
-            parts = parts[2:-1]
-            while parts:
-                # keep adding components to the end until we reach the capacity
-                c = parts.pop() + '/' + end
-                if len(c) <= size - 3:
-                    left = '**/{}'.format(c)
-                    end = c
-                    continue
-                # once we cannot add whole components to the end, see if we can
-                # add whole components to the start.
-                if parts:
+            if k < len(suffixes) - 1:
+                # once we cannot add whole components to the end, see if we
+                # can add whole components to the start.
+                if k < len(suffixes) - 2:
                     start.append('**')
                 else:
                     start.append('*')
@@ -1183,7 +1436,6 @@ class LivePanel:
                     c = start[0] + '/**/' + end
                     if len(c) <= size:
                         left = c
-                break
             else:
                 # We added everything but the first two path components.
                 # We know that the whole path doesn't fit, so check if
@@ -1220,7 +1472,20 @@ class LivePanel:
             uncache_panel(view)
             window.destroy_output_panel(panel_name)
         view = window.create_output_panel(panel_name)
+        # Scopes that have been given regions in the view. There are hundreds
+        # of possible scopes, but few are used.
+        self.active_scopes = set()  # type: set[str]
+        # Copies of the scope regions, valid while the view is only appended
+        self._scope_regions = {}  # type: dict[str, list[sublime.Region]]
+        # Scopes whose copies have changed since they were added to the view
+        self.dirty_scopes = set()  # type: set[str]
+        # Cached positions in the view, cleared when the view changes
+        self._rowcols = {}  # type: dict[int, tuple[int, int]]
+        self._text_points = {}  # type: dict[tuple[int, int], int]
+        self._lines = {}  # type: dict[int, sublime.Region]
+        self._size = None  # type: int|None
         view.set_read_only(True)
+        self.unlocked = False
         view.set_scratch(True)
         view.set_line_endings('Unix')
 
@@ -1244,33 +1509,145 @@ class LivePanel:
 
         return view
 
+    def size(self):
+        # type: () -> int
+        size = self._size
+        if size is None:
+            size = self._size = self.view.size()
+        return size
+
+    def rowcol(self, point):
+        # type: (int) -> tuple[int, int]
+        # Cursor movements look up the same positions repeatedly between
+        # edits, so remember the results rather than asking the view.
+        rowcol = self._rowcols.get(point)
+        if rowcol is None:
+            rowcol = self._rowcols[point] = self.view.rowcol(point)
+        return rowcol
+
+    def text_point(self, row, col):
+        # type: (int, int) -> int
+        point = self._text_points.get((row, col))
+        if point is None:
+            point = self._text_points[row, col] = self.view.text_point(row, col)
+        return point
+
+    def line(self, point):
+        # type: (int) -> sublime.Region
+        # The line containing `point`, excluding any newline. This gives both
+        # ends of the line from one call to the view.
+        line = self._lines.get(point)
+        if line is None:
+            line = self._lines[point] = self.view.line(point)
+        return line
+
+    @contextlib.contextmanager
+    def writable(self):
+        # () -> Iterator[None]
+        # Allow changes to the read-only view. Inside a `batch`, the view
+        # stays writable until the batch ends.
+        self.sync_scopes()
+        if not self.unlocked:
+            self.view.set_read_only(False)
+            self.unlocked = True
+        try:
+            yield
+        finally:
+            if self.batches == 0:
+                self.relock()
+
+    @contextlib.contextmanager
+    def batch(self):
+        # () -> Iterator[None]
+        # Update changed scopes and make the view read-only once, after a
+        # series of edits.
+        self.batches += 1
+        try:
+            yield
+        finally:
+            self.batches -= 1
+            if self.batches == 0:
+                self.sync_scopes()
+                self.relock()
+
+    def relock(self):
+        # type: () -> None
+        if self.unlocked:
+            self.view.set_read_only(True)
+            self.unlocked = False
+
+    def view_changed(self, appended=False):
+        # type: (bool) -> None
+        # Call after every change to the view text. Appending text does not
+        # move any existing regions, or the row and column of existing points.
+        self._text_points.clear()
+        self._lines.clear()
+        self._size = None
+        if not appended:
+            self._rowcols.clear()
+            self._scope_regions.clear()
+
+    def push_soon(self):
+        # type: () -> None
+        # Push now, unless the last push was very recent. In that case, push
+        # after an interval, so the final state is always displayed.
+        if time.monotonic() - self.push_time >= push_interval:
+            self.push()
+        elif not self.push_pending:
+            self.push_pending = True
+            sublime.set_timeout(self.push_deferred, int(push_interval * 1000))
+
+    def push_deferred(self):
+        # type: () -> None
+        if self.push_pending:
+            self.push()
+
     def push(self):
         # type: () -> None
+        self.push_time = time.monotonic()
+        self.push_pending = False
         view = self.view
-        home = view.text_point(self.home_row, 0)
-        scopes = get_scopes(self.view)
+        home = self.text_point(self.home_row, 0)
+        # Text before `home` moves to the display panel. Usually there is
+        # none, leaving only the preview to update.
+        if home > 0:
+            text = view.substr(sublime.Region(0, home))
+            # Only ask the view for scope regions that are not copied here.
+            scopes = get_scopes(view, self.active_scopes.difference(self._scope_regions))
+            for scope, regions in self._scope_regions.items():
+                if regions:
+                    scopes[scope] = regions
+        else:
+            text = ''
+            scopes = {}
         self.display_panel.add_output(
-            view.substr(sublime.Region(0, view.size())),
-            home,
+            text,
+            view.substr(sublime.Region(home, self.size())),
             self.cursor,
             scopes,
         )
-        view.set_read_only(False)
-        try:
-            view.run_command('gidterm_erase_text', {'begin': 0, 'end': home})
-        finally:
-            view.set_read_only(True)
+        if home > 0:
+            with self.writable():
+                view.run_command('gidterm_erase_text', {'begin': 0, 'end': home})
+            self.view_changed()
         assert self.cursor >= home
         self.cursor -= home
         self.home_row = 0
 
+    def wake_on_output(self, handler):
+        # type: (Callable[[], None]) -> None
+        # Run `handler` on the UI thread when the terminal has more output,
+        # instead of polling for it.
+        assert self.terminal is not None
+        self.terminal.notify(functools.partial(sublime.set_timeout, handler, 0))
+
     def wait_for_prompt(self):
         # type: () -> None
         if self.terminal:
             count = 0
             for t in self.terminal_output:
                 if isinstance(t, TerminalOutput.NotReady):
-                    sublime.set_timeout(self.wait_for_prompt, 100)
+                    self.wake_on_output(self.wait_for_prompt)
                     break
                 if isinstance(t, TerminalOutput.OutputStops):
                     # prompt about to be emitted
@@ -1289,25 +1666,39 @@ class LivePanel:
                 self.terminal_closed()
 
     def handle_output(self):
+        # type: () -> None
+        with self.batch():
+            self._handle_output()
+
+    def _handle_output(self):
         # type: () -> None
         if self.terminal:
             update_preview = False
             view = self.view
             count = 0
+            # Consecutive text is written in one edit, before the next event.
+            # Color changes are recorded as runs of (scope, length) so that
+            # colored text can be written together.
+            pending = []  # type: list[str]
+            runs = []  # type: list[tuple[str, int]]
             for t in self.terminal_output:
+                if pending and not isinstance(t, (TerminalOutput.Text, TerminalOutput.SelectGraphicRendition)):
+                    self.write_runs(''.join(pending), runs)
+                    pending = []
+                    runs = []
                 if isinstance(t, TerminalOutput.NotReady):
-                    sublime.set_timeout(self.handle_output, 100)
+                    self.wake_on_output(self.handle_output)
                     break
                 if isinstance(t, TerminalOutput.Prompt1Starts):
                     self.command_start = None
-                    assert self.cursor == view.size(), (self.cursor, view.size())
+                    assert self.cursor == self.size(), (self.cursor, self.size())
                 elif isinstance(t, TerminalOutput.Prompt1Stops):
-                    assert self.cursor == view.size()
+                    assert self.cursor == self.size()
                     self.command_start = self.cursor
                     self.command_range = []
                     self.scope = ''
                 elif isinstance(t, TerminalOutput.Prompt2Starts):
-                    assert self.cursor == view.size()
+                    assert self.cursor == self.size()
                     end = self.cursor - 1
                     assert view.substr(end) == '\n'
                     assert self.command_range is not None
@@ -1315,13 +1706,13 @@ class LivePanel:
                     self.command_start = None
                     self.scope = 'sgr.magenta-on-default'
                 elif isinstance(t, TerminalOutput.Prompt2Stops):
-                    assert self.cursor == view.size()
+                    assert self.cursor == self.size()
                     assert self.command_start is None
                     self.command_start = self.cursor
                     self.scope = ''
                 elif isinstance(t, TerminalOutput.OutputStarts):
                     self.out_start_time = datetime.now(timezone.utc)
-                    assert self.cursor == view.size()
+                    assert self.cursor == self.size()
                     end = self.cursor - 1
                     assert view.substr(end) == '\n'
                     command_range = self.command_range
@@ -1334,15 +1725,19 @@ class LivePanel:
                     # view = self.view = self.reset_view(self.display_panel, self.panel_name, self.pwd)
                     # Re-add the command without prompts. Note that it has been pushed.
                     # self.append_text(command + '\n')
-                    # self.cursor = self.pushed = view.size()
+                    # self.cursor = self.pushed = self.size()
                     # view.add_regions('command', [sublime.Region(0, self.cursor)], 'sgr.default-on-yellow', flags=0)
-                    try:
-                        words = shlex.split(command.strip())
-                    except ValueError as e:
-                        # after a PS2 prompt, this indicates the start of a shell interaction
-                        # TODO: handle this properly
-                        warn(str(e))
-                        words = ['shell']
+                    if not ('"' in command or "'" in command or '\\' in command):
+                        # Without quotes or escapes, shlex splits on whitespace
+                        words = command.split()
+                    else:
+                        try:
+                            words = shlex.split(command.strip())
+                        except ValueError as e:
+                            # after a PS2 prompt, this indicates the start of a shell interaction
+                            # TODO: handle this properly
+                            warn(str(e))
+                            words = ['shell']
                     if '/' in words[0]:
                         words[0] = words[0].rsplit('/', 1)[-1]
                     self.command_words = words
@@ -1355,7 +1750,7 @@ class LivePanel:
                         # end of an executed command
                         status = t.status
                         self.display_status(status)
-                        self.home_row, col = view.rowcol(view.size())
+                        self.home_row, col = self.rowcol(self.size())
                         assert col == 0, col
                         self.push()
                         view = self.view = self.reset_view(self.display_panel, self.panel_name, self.pwd)
@@ -1375,114 +1770,85 @@ class LivePanel:
                         self.set_title()
                         self.command_start = None
                 elif isinstance(t, TerminalOutput.Text):
-                    self.overwrite(t.text)
+                    pending.append(t.text)
+                    if runs and runs[-1][0] == self.scope:
+                        runs[-1] = (self.scope, runs[-1][1] + len(t.text))
+                    else:
+                        runs.append((self.scope, len(t.text)))
                     update_preview = True
                 elif isinstance(t, TerminalOutput.CursorUp):
-                    row, col = view.rowcol(self.cursor)
+                    row, col = self.rowcol(self.cursor)
                     row -= t.n
                     if row < 0:
                         row = 0
-                    cursor = view.text_point(row, col)
-                    if view.rowcol(cursor)[0] > row:
-                        cursor = view.text_point(row + 1, 0) - 1
+                    cursor = self.text_point(row, col)
+                    if self.rowcol(cursor)[0] > row:
+                        cursor = self.text_point(row + 1, 0) - 1
                     self.cursor = cursor
                     update_preview = True
                 elif isinstance(t, TerminalOutput.CursorDown):
-                    row, col = view.rowcol(self.cursor)
+                    row, col = self.rowcol(self.cursor)
                     row += t.n
-                    cursor = view.text_point(row, col)
-                    if view.rowcol(cursor)[0] > row:
-                        cursor = view.text_point(row + 1, 0) - 1
+                    cursor = self.text_point(row, col)
+                    if self.rowcol(cursor)[0] > row:
+                        cursor = self.text_point(row + 1, 0) - 1
                     self.cursor = cursor
                     update_preview = True
                 elif isinstance(t, TerminalOutput.CursorLeft):
                     self.cursor = max(self.cursor - t.n, 0)
                     update_preview = True
                 elif isinstance(t, TerminalOutput.CursorRight):
-                    self.cursor = min(self.cursor + t.n, view.size())
+                    self.cursor = min(self.cursor + t.n, self.size())
                     update_preview = True
                 elif isinstance(t, TerminalOutput.CursorMoveTo):
-                    row = view.rowcol(view.size())[0] - terminal_rows + 1
+                    row = self.rowcol(self.size())[0] - terminal_rows + 1
                     if row < self.home_row:
                         row = self.home_row
                     else:
                         self.home_row = row
                     row += t.row
                     col = t.col
-                    cursor = view.text_point(row, col)
-                    if view.rowcol(cursor)[0] > row:
-                        cursor = view.text_point(row + 1, 0) - 1
+                    cursor = self.text_point(row, col)
+                    if self.rowcol(cursor)[0] > row:
+                        cursor = self.text_point(row + 1, 0) - 1
                         # This puts cursor at end of line `row`. Maybe add spaces
                         # to get to column `col`?
                     self.cursor = cursor
                     update_preview = True
                 elif isinstance(t, TerminalOutput.CursorReturn):
                     # move cursor to start of line
-                    classification = view.classify(self.cursor)
-                    if not classification & sublime.CLASS_LINE_START:
-                        bol = view.find_by_class(
-                            self.cursor,
-                            forward=False,
-                            classes=sublime.CLASS_LINE_START
-                        )
-                        self.cursor = bol
+                    self.cursor = self.line(self.cursor).begin()
                     update_preview = True
                 elif isinstance(t, TerminalOutput.LineFeed):
-                    row, col = view.rowcol(self.cursor)
-                    end = view.size()
-                    maxrow, _ = view.rowcol(end)
+                    row, col = self.rowcol(self.cursor)
+                    end = self.size()
+                    maxrow, _ = self.rowcol(end)
                     if row == maxrow:
                         self.append_text('\n')
-                        self.cursor = view.size()
+                        self.cursor = self.size()
                         new_home_row = row - terminal_rows + 1
                         if new_home_row > self.home_row:
                             self.home_row = new_home_row
                     else:
                         row += 1
-                        cursor = view.text_point(row, col)
-                        if view.rowcol(cursor)[0] > row:
-                            cursor = view.text_point(row + 1, 0) - 1
+                        cursor = self.text_point(row, col)
+                        if self.rowcol(cursor)[0] > row:
+                            cursor = self.text_point(row + 1, 0) - 1
                         self.cursor = cursor
                     update_preview = True
                 elif isinstance(t, TerminalOutput.ClearToEndOfLine):
-                    classification = view.classify(self.cursor)
-                    if not classification & sublime.CLASS_LINE_END:
-                        eol = view.find_by_class(
-                            self.cursor,
-                            forward=True,
-                            classes=sublime.CLASS_LINE_END
-                        )
+                    eol = self.line(self.cursor).end()
+                    if eol > self.cursor:
                         self.erase(self.cursor, eol)
                     update_preview = True
                 elif isinstance(t, TerminalOutput.ClearToStartOfLine):
-                    classification = view.classify(self.cursor)
-                    if not classification & sublime.CLASS_LINE_START:
-                        bol = view.find_by_class(
-                            self.cursor,
-                            forward=False,
-                            classes=sublime.CLASS_LINE_START
-                        )
+                    bol = self.line(self.cursor).begin()
+                    if bol < self.cursor:
                         self.erase(bol, self.cursor)
                     update_preview = True
                 elif isinstance(t, TerminalOutput.ClearLine):
-                    classification = view.classify(self.cursor)
-                    if classification & sublime.CLASS_LINE_START:
-                        bol = self.cursor
-                    else:
-                        bol = view.find_by_class(
-                            self.cursor,
-                            forward=False,
-                            classes=sublime.CLASS_LINE_START
-                        )
-                    if classification & sublime.CLASS_LINE_END:
-                        eol = self.cursor
-                    else:
-                        eol = view.find_by_class(
-                            self.cursor,
-                            forward=True,
-                            classes=sublime.CLASS_LINE_END
-                        )
-                    self.erase(bol, eol)
+                    line = self.line(self.cursor)
+                    self.erase(line.begin(), line.end())
                     update_preview = True
                 elif isinstance(t, TerminalOutput.Insert):
                     # keep cursor at start
@@ -1494,23 +1860,27 @@ class LivePanel:
                     self.delete(self.cursor, self.cursor + t.n)
                     update_preview = True
                 elif isinstance(t, TerminalOutput.SelectGraphicRendition):
-                    scope = 'sgr.{}-on-{}'.format(t.foreground, t.background)
-                    if scope == 'sgr.default-on-default':
-                        scope = ''
-                    self.scope = scope
+                    self.scope = _sgr_scopes[t.foreground, t.background]
                 else:
                     warn('unexpected token: {}'.format(t))
                 count += 1
                 if count > 100:
+                    if pending:
+                        self.write_runs(''.join(pending), runs)
                     # give other events a chance to run
                     sublime.set_timeout(self.handle_output, 0)
                     break
             else:
+                if pending:
+                    self.write_runs(''.join(pending), runs)
                 self.terminal_closed()
             if update_preview:
-                self.push()
-            if all(region.empty() for region in view.sel()):
-                view.run_command('gidterm_cursor', {'position': self.cursor})
+                self.push_soon()
+            sel = view.sel()
+            if all(region.empty() for region in sel):
+                # Skip the command if the caret is already at the cursor.
+                if len(sel) != 1 or sel[0].b != self.cursor:
+                    view.run_command('gidterm_cursor', {'position': self.cursor})
 
     def terminal_closed(self):
         # type: () -> None
@@ -1519,7 +1889,7 @@ class LivePanel:
         self.terminal = None
         self.display_status('DISCONNECTED')
         view = self.view
-        self.home_row, col = view.rowcol(view.size())
+        self.home_row, col = self.rowcol(self.size())
         assert col == 0, col
         self.push()
         self.view = self.reset_view(self.display_panel, self.panel_name, self.pwd)
@@ -1538,8 +1908,8 @@ class LivePanel:
         # type: (str) -> None
         # finished displaying output of command
         view = self.view
-        output_end = view.size()
-        col = view.rowcol(output_end)[1]
+        output_end = self.size()
+        col = self.rowcol(output_end)[1]
         if self.cursor == output_end:
             if col == 0:
                 # cursor at end, with final newline
@@ -1573,11 +1943,9 @@ class LivePanel:
 
     def _insert(self, view, start, text):
         # type: (sublime.View, int, str) -> int
-        view.set_read_only(False)
-        try:
+        with self.writable():
             view.run_command('gidterm_insert_text', {'point': start, 'characters': text})
-        finally:
-            view.set_read_only(True)
+        self.view_changed()
         return start + len(text)
 
     def insert_text(self, text):
@@ -1588,63 +1956,114 @@ class LivePanel:
         # type: (sublime.View, int, str) -> int
         # Overwrite text to end of line, then insert additional text
         end = start + len(text)
-        classification = view.classify(start)
-        if classification & sublime.CLASS_LINE_END:
-            replace_end = start
-        else:
-            replace_end = view.find_by_class(start, forward=True, classes=sublime.CLASS_LINE_END)
+        replace_end = self.line(start).end()
         if end < replace_end:
             replace_end = end
-        view.set_read_only(False)
-        try:
+        with self.writable():
             view.run_command('gidterm_replace_text', {'begin': start, 'end': replace_end, 'characters': text})
-        finally:
-            view.set_read_only(True)
+        self.view_changed()
         return end
 
     def overwrite(self, text):
         # type: (str) -> None
         self._write(text, self._overwrite)
 
+    def write_runs(self, text, runs):
+        # type: (str, list[tuple[str, int]]) -> None
+        # Write text made of runs of (scope, length) in a single edit. The
+        # text contains no newlines, so overwriting it all at once gives the
+        # same result as overwriting each run in turn.
+        start = self.cursor
+        if start == self.size():
+            self._append(text)
+        else:
+            self.cursor = self._overwrite(self.view, start, text)
+        for scope, length in runs:
+            end = start + length
+            if scope:
+                self.add_scope_region(scope, start, end)
+            start = end
+
     def append_text(self, text):
         # type: (str) -> None
+        start, end = self._append(text)
+        if self.scope:
+            self.add_scope_region(self.scope, start, end)
+
+    def _append(self, text):
+        # type: (str) -> tuple[int, int]
         view = self.view
-        start = view.size()
+        start = self.size()
         end = start + len(text)
         view.run_command('append', {'characters': text, 'force': True, 'scroll_to_end': True})
-        if end != view.size():
-            warn('cursor not at end after writing {!r} {} {}'.format(text, end, view.size()))
-            end = view.size()
-        if self.scope:
-            regions = view.get_regions(self.scope)
-            if regions and regions[-1].end() == start:
-                prev = regions.pop()
-                region = sublime.Region(prev.begin(), end)
-            else:
-                region = sublime.Region(start, end)
-            regions.append(region)
-            view.add_regions(self.scope, regions, self.scope, flags=sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT)
-
+        self.view_changed(appended=True)
+        if end != self.size():
+            warn('cursor not at end after writing {!r} {} {}'.format(text, end, self.size()))
+            end = self.size()
+        else:
+            # Output is mostly appended, so work out the position of the new
+            # end from the old one, rather than asking the view.
+            rowcol = self._rowcols.get(start)
+            if rowcol is not None:
+                row, col = rowcol
+                newlines = text.count('\n')
+                if newlines:
+                    rowcol = (row + newlines, len(text) - text.rfind('\n') - 1)
+                else:
+                    rowcol = (row, col + len(text))
+                self._rowcols[end] = rowcol
         self.cursor = end
+        return start, end
+
+    def add_scope_region(self, scope, start, end):
+        # type: (str, int, int) -> None
+        # Inside a batch, the view is updated once for each changed scope,
+        # either when the batch ends or before an edit that moves regions.
+        self.extend_scope(scope, start, end)
+        if self.batches:
+            self.dirty_scopes.add(scope)
+        else:
+            self.sync_scope(scope)
+
+    def sync_scopes(self):
+        # type: () -> None
+        for scope in self.dirty_scopes:
+            self.sync_scope(scope)
+        self.dirty_scopes.clear()
+
+    def extend_scope(self, scope, start, end):
+        # type: (str, int, int) -> None
+        # Add a region to the copy of the scope regions, merging it with a
+        # region that ends at the start. The view is not updated until
+        # `sync_scope` is called, which must happen before the next edit
+        # that is not an append.
+        self.active_scopes.add(scope)
+        regions = self._scope_regions.get(scope)
+        if regions is None:
+            regions = self._scope_regions[scope] = self.view.get_regions(scope)
+        if regions and regions[-1].end() == start:
+            prev = regions.pop()
+            region = sublime.Region(prev.begin(), end)
+        else:
+            region = sublime.Region(start, end)
+        regions.append(region)
+
+    def sync_scope(self, scope):
+        # type: (str) -> None
+        regions = self._scope_regions[scope]
+        self.view.add_regions(scope, regions, scope, flags=sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT)
 
     def _write(self, text, add_text):
         # (str, Callable[[sublime.View, int, str], None]) -> None
         view = self.view
         start = self.cursor
-        if start == view.size():
+        if start == self.size():
             self.append_text(text)
         else:
             end = add_text(view, start, text)
 
             if self.scope:
-                regions = view.get_regions(self.scope)
-                if regions and regions[-1].end() == start:
-                    prev = regions.pop()
-                    region = sublime.Region(prev.begin(), end)
-                else:
-                    region = sublime.Region(start, end)
-                regions.append(region)
-                view.add_regions(self.scope, regions, self.scope, flags=sublime.DRAW_NO_OUTLINE | sublime.PERSISTENT)
+                self.add_scope_region(self.scope, start, end)
 
             self.cursor = end
 
@@ -1653,35 +2072,27 @@ class LivePanel:
         # Erase the region without shifting characters after the region. This
         # may require replacing the erased characters with placeholders.
         view = self.view
-        classification = view.classify(begin)
-        if classification & sublime.CLASS_LINE_END:
-            eol = begin
-        else:
-            eol = view.find_by_class(begin, forward=True, classes=sublime.CLASS_LINE_END)
+        eol = self.line(begin).end()
         if eol <= end:
             self.delete(begin, eol)
         else:
             length = end - begin
             if length > 0:
-                view.set_read_only(False)
-                try:
+                with self.writable():
                     view.run_command(
                         'gidterm_replace_text', {'begin': begin, 'end': end, 'characters': '\ufffd' * length}
                     )
-                finally:
-                    view.set_read_only(True)
+                self.view_changed()
 
     def delete(self, begin, end):
         # type: (int, int) -> None
         # Delete the region, shifting any later characters into the space.
         if begin < end:
             view = self.view
-            assert begin >= view.text_point(self.home_row, 0)
-            view.set_read_only(False)
-            try:
+            assert begin >= self.text_point(self.home_row, 0)
+            with self.writable():
                 view.run_command('gidterm_erase_text', {'begin': begin, 'end': end})
-            finally:
-                view.set_read_only(True)
+            self.view_changed()
             if self.cursor > end:
                 self.cursor -= (end - begin)
             elif self.cursor > begin:
@@ -1689,20 +2100,34 @@ class LivePanel:
 
     def follow(self):
         # type: () -> None
-        # move prompt panel cursor to current position
-        self.view.run_command('gidterm_cursor', {'position': self.cursor})
+        # move prompt panel cursor to current position. This is only called
+        # from `gidterm_follow` running in this view, so the selection can be
+        # changed directly instead of through another command.
+        view = self.view
+        sel = view.sel()
+        sel.clear()
+        sel.add(self.cursor)
+        view.show(self.cursor)
         # move display panel cursor to end, causing it to follow output
         self.display_panel.follow()
 
 
 def create_init_file(contents):
     # type: (str) -> str
+    # tempfile pulls in random and weakref, so only import it when the first
+    # terminal starts, rather than while Sublime Text loads plugins.
+    import tempfile
     cachedir = os.path.expanduser('~/.cache/sublime-gidterm/profile')
     os.makedirs(cachedir, exist_ok=True)
     fd, name = tempfile.mkstemp(dir=cachedir)
     try:
-        contents += 'declare -- GIDTERM_CACHE="%s"\n' % name
-        os.write(fd, contents.encode('utf-8'))
+        if contents == _initial_profile:
+            data = _initial_profile_bytes
+        else:
+            data = contents.encode('utf-8')
+        cache = 'declare -- GIDTERM_CACHE="%s"\n' % name
+        # Write both parts without joining them into another copy
+        os.writev(fd, (data, cache.encode('utf-8')))
     finally:
         os.close(fd)
     return name
@@ -1736,8 +2161,7 @@ class GidtermCommand(sublime_plugin.TextCommand):
         if pwd is None:
             pwd = winvar.get('folder', os.environ.get('HOME', '/'))
 
-        package = _get_package_location(winvar)
-        color_scheme = os.path.join(package, 'gidterm.sublime-color-scheme')
+        color_scheme = _get_color_scheme(winvar['packages'])
 
         display_view = window.new_file()
         display_view.set_read_only(True)
@@ -1864,24 +2288,38 @@ class GidtermCapabilityCommand(sublime_plugin.TextCommand):
     def run(self, edit, cap):
         # type: (...) -> None
         characters = _terminal_capability_map.get(cap)
-        if characters is None:
-            warn('unexpected terminal capability: {}'.format(cap))
+        if not characters:
+            # Capabilities with no sequence are bound only to stop Sublime
+            # Text acting on the key, so there is nothing to send.
+            if characters is None:
+                warn('unexpected terminal capability: {}'.format(cap))
             return
         panel = get_panel(self.view)
         if panel:
             panel.handle_input(characters)
 
 
+def insert_clipboard(panel, strip, buf):
+    # type: (DisplayPanel|LivePanel, bool, str) -> None
+    if strip:
+        buf = buf.strip()
+    panel.handle_input(buf)
+
+
 class GidtermInsertCommand(sublime_plugin.TextCommand):
 
     def run(self, edit, strip):
         # type: (...) -> None
         panel = get_panel(self.view)
         if panel is not None:
-            buf = sublime.get_clipboard()
-            if strip:
-                buf = buf.strip()
-            panel.handle_input(buf)
+            try:
+                get_clipboard_async = sublime.get_clipboard_async
+            except AttributeError:
+                # Sublime Text 3
+                insert_clipboard(panel, strip, sublime.get_clipboard())
+            else:
+                # Avoid blocking the UI while a large clipboard is fetched
+                get_clipboard_async(functools.partial(insert_clipboard, panel, strip))
 
 
 class GidtermSelectCommand(sublime_plugin.TextCommand):
@@ -1923,16 +2361,14 @@ class GidtermLiveListener(sublime_plugin.EventListener):
 
     def on_activated(self, view):
         # type: (sublime.View) -> None
-        if view.settings().get('is_gidterm_live', False):
-            panel = get_panel(view)
-            if panel is not None:
-                assert isinstance(panel, LivePanel)
-                panel.set_active(True)
+        # This is called for every view, so check the panel cache rather
+        # than the view settings.
+        panel = panel_cache.get(view.id())
+        if isinstance(panel, LivePanel):
+            panel.set_active(True)
 
     def on_deactivated(self, view):
         # type: (sublime.View) -> None
-        if view.settings().get('is_gidterm_live', False):
-            panel = get_panel(view)
-            if panel is not None:
-                assert isinstance(panel, LivePanel)
-                panel.set_active(False)
+        panel = panel_cache.get(view.id())
+        if isinstance(panel, LivePanel):
+            panel.set_active(False)
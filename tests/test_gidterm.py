@@ -50,6 +50,382 @@ class TestDecode(TestCase):
         )
 
 
+class TestDecodeChunks(TestCase):
+
+    def decode_chunks(self, data, size):
+        # decode data read in chunks of `size` bytes, as TerminalReader does
+        result = ''
+        undecoded = b''
+        for i in range(0, len(data), size):
+            undecoded += data[i:i + size]
+            end = gidterm.utf8_complete(undecoded)
+            result += undecoded[:end].decode('utf8', 'gidterm')
+            undecoded = undecoded[end:]
+        return result + undecoded.decode('utf8', 'gidterm')
+
+    def test_utf8_complete(self):
+        data = 'a\u00e3\u20ac\U0001F60A'.encode('utf8')
+        # each length ends inside a character of 1, 2, 3 and 4 bytes
+        expected = [0, 1, 1, 3, 3, 3, 6, 6, 6, 6, 10]
+        for i in range(len(data) + 1):
+            self.assertEqual(expected[i], gidterm.utf8_complete(data[:i]), i)
+
+    def test_utf8_complete_invalid(self):
+        # bytes that cannot start a character are left for the decoder
+        self.assertEqual(3, gidterm.utf8_complete(b'ab\xa0'))
+        self.assertEqual(4, gidterm.utf8_complete(b'\x80\x80\x80\x80'))
+
+    def test_decode_chunks(self):
+        text = 'gid\U0001F60Aterm \u00e3\u20ac done'
+        data = text.encode('utf8')
+        for size in range(1, 6):
+            self.assertEqual(text, self.decode_chunks(data, size), size)
+
+    def test_decode_chunks_invalid(self):
+        data = b'gid\xa0term \xe3\xa0 \xf0\x9f\x98 done\xe2'
+        expected = data.decode('utf8', 'gidterm')
+        for size in range(1, 6):
+            self.assertEqual(expected, self.decode_chunks(data, size), size)
+
+    def test_decode_error_single_bytes(self):
+        # a byte that is not part of a UTF-8 character is decoded as
+        # Windows-1252, or a replacement character where that is undefined
+        for b in range(0x80, 0x100):
+            self.assertEqual(
+                'x{}y'.format(bytes([b]).decode('windows-1252', 'replace')),
+                (b'x' + bytes([b]) + b'y').decode('utf8', 'gidterm'),
+                hex(b)
+            )
+
+    def test_decode_error_multiple_bytes(self):
+        self.assertEqual(
+            'x\u00f0\u0178\u02dcy',
+            b'x\xf0\x9f\x98y'.decode('utf8', 'gidterm')
+        )
+
+
+class TestTerminalOutput(TestCase):
+
+    samples = [
+        'hello world\r\n',
+        '\x1b[31mred\x1b[0m plain \x1b[1;32mgreen\x1b[0m\r\n',
+        'abcdef\x08\x08\x1b[K\r\n',
+        '12345\x1b[3D\x1b[2@\x1b[@\x1b[1P\x1b[P\r\n',
+        'line1\r\nline2\x1b[A\x1b[Cup\x1b[3B\x1b[B\x1b[D\r\n',
+        '\x1b[38;5;196mx\x1b[48;2;10;20;30my\x1b[0m\r\n',
+        '\x1b]0;some long title text here\x07after\x1b]0;t2\x1b\\x',
+        '\x1b[1p0@/tmp\x1b[~\x1b[5p$ \x1b[~',
+        '\x1b[1p1@/home/user/some dir\x1b[~\x1b[5p\x1b[32muser\x1b[0m@host:\r\n$ \x1b[~',
+        'tab\there\x07 bell\x1b(B\x1b[H\x1b[5;3Hxy\r\n',
+    ]
+
+    def events(self, chunks):
+        # Return the events for the text in `chunks`, joining adjacent Text
+        # events and runs of backspaces or CR's, which depend on where the
+        # text was split.
+        output = gidterm.TerminalOutput(None)
+        Text = gidterm.TerminalOutput.Text
+        runs = (gidterm.TerminalOutput.CursorLeft, gidterm.TerminalOutput.CursorReturn)
+        events = []
+        for chunk in chunks:
+            for event in output.handle_output(chunk):
+                if events and type(event) is type(events[-1]):
+                    if isinstance(event, Text):
+                        event = Text(events.pop().text + event.text)
+                    elif isinstance(event, runs):
+                        event = type(event)(events.pop().n + event.n)
+                events.append(event)
+        return events
+
+    def test_split_events(self):
+        for sample in self.samples:
+            expected = self.events([sample])
+            for i in range(1, len(sample)):
+                self.assertEqual(
+                    expected, self.events([sample[:i], sample[i:]]), repr(sample[:i])
+                )
+
+    def test_split_into_characters(self):
+        for sample in self.samples:
+            self.assertEqual(self.events([sample]), self.events(list(sample)), repr(sample))
+
+    def test_text_merged(self):
+        # text either side of an ignored control is yielded as one event
+        output = gidterm.TerminalOutput(None)
+        self.assertEqual(
+            [gidterm.TerminalOutput.Text('ab\u2713c')],
+            list(output.handle_output('a\x07b\u2713\x1b(Bc'))
+        )
+
+    def test_partial_escape_saved(self):
+        output = gidterm.TerminalOutput(None)
+        self.assertEqual(
+            [gidterm.TerminalOutput.Text('abc')],
+            list(output.handle_output('abc\x1b[3'))
+        )
+        self.assertEqual(
+            [
+                gidterm.TerminalOutput.SelectGraphicRendition('red', 'default'),
+                gidterm.TerminalOutput.Text('x'),
+            ],
+            list(output.handle_output('1mx'))
+        )
+
+    def test_partial_title_saved(self):
+        output = gidterm.TerminalOutput(None)
+        self.assertEqual([], list(output.handle_output('\x1b]0;a long')))
+        self.assertEqual([], list(output.handle_output(' title')))
+        self.assertEqual(
+            [gidterm.TerminalOutput.Text('after')],
+            list(output.handle_output('\x07after'))
+        )
+
+    def test_csi_count(self):
+        self.assertEqual(1, gidterm._csi_count(''))
+        self.assertEqual(3, gidterm._csi_count('3'))
+        self.assertEqual(250, gidterm._csi_count('250'))
+
+    def test_delete_default_count(self):
+        output = gidterm.TerminalOutput(None)
+        self.assertEqual(
+            [
+                gidterm.TerminalOutput.Delete(1),
+                gidterm.TerminalOutput.Delete(3),
+                gidterm.TerminalOutput.Insert(1),
+                gidterm.TerminalOutput.CursorLeft(1),
+            ],
+            list(output.handle_output('\x1b[P\x1b[3P\x1b[@\x1b[D'))
+        )
+
+
+class LabelPanel:
+    # A stand-in for a LivePanel, holding only the values used for labels
+
+    def __init__(self, pwd, command_words):
+        self.pwd = pwd
+        self.command_words = command_words
+
+
+class TestMakeLabel(TestCase):
+
+    pwd = '/home/user/src/project/module'
+
+    def labels(self, command_words, sizes):
+        panel = LabelPanel(self.pwd, command_words)
+        return [gidterm.LivePanel.make_label(panel, size) for size in sizes]
+
+    def test_path_suffixes(self):
+        parts, suffixes, lengths = gidterm._path_suffixes(self.pwd)
+        self.assertEqual(['', 'home', 'user', 'src', 'project', 'module'], parts)
+        self.assertEqual(
+            ['module', 'project/module', 'src/project/module', 'user/src/project/module'],
+            suffixes
+        )
+        self.assertEqual([len(suffix) for suffix in suffixes], lengths)
+
+    def test_path_suffixes_short(self):
+        self.assertEqual((['~'], ['~'], [1]), gidterm._path_suffixes('~'))
+        self.assertEqual((['', 'tmp'], ['tmp'], [3]), gidterm._path_suffixes('/tmp'))
+
+    def test_idle_label(self):
+        self.assertEqual(
+            [
+                '', '$', '\u2025$', '**/module$', '/**/module$',
+                '/**/project/module$', '/**/src/project/module$',
+                '/home/user/src/project/module$',
+            ],
+            self.labels([], [0, 1, 2, 10, 14, 20, 24, 32])
+        )
+
+    def test_command_label(self):
+        self.assertEqual(
+            [
+                '$ g\u2026', '$ git \u2025', '**/*ule$ git \u2025',
+                '**/module$ git comm\u2025', '**/module$ git commit -m message',
+                '**/project/module$ git commit -m message',
+            ],
+            self.labels(['git', 'commit', '-m', 'message'], [5, 10, 14, 20, 32, 40])
+        )
+
+
+class TestSelectGraphicRendition(TestCase):
+
+    def rendition(self, arg):
+        output = gidterm.TerminalOutput(None)
+        return output.handle_rendition(arg)
+
+    def test_8bit_colors_table(self):
+        self.assertEqual(256, len(gidterm._sgr_8bit_colors))
+        for idx, color in enumerate(gidterm._sgr_8bit_colors):
+            self.assertEqual(gidterm._sgr_8bit_color(idx), color)
+        self.assertEqual('red', gidterm._sgr_8bit_colors[1])
+        self.assertEqual('brightred', gidterm._sgr_8bit_colors[9])
+        self.assertEqual('brightblack', gidterm._sgr_8bit_colors[240])
+        self.assertEqual('brightwhite', gidterm._sgr_8bit_colors[255])
+
+    def test_8bit_color(self):
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('brightred', 'brightblue'),
+            self.rendition('38;5;196;48;5;21')
+        )
+
+    def test_8bit_color_out_of_range(self):
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('brightwhite', 'default'),
+            self.rendition('38;5;999')
+        )
+
+    def test_24bit_color(self):
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('brightred', 'white'),
+            self.rendition('38;2;255;0;0;48;2;200;200;200')
+        )
+
+    def test_24bit_color_skips_arguments(self):
+        # the r;g;b values must not be handled as SGR codes, which would
+        # set the foreground to red
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('default', 'brightblack'),
+            self.rendition('48;2;31;1;0')
+        )
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('default', 'green'),
+            self.rendition('38;2;31;1;0;0;42')
+        )
+
+    def test_24bit_color_missing_arguments(self):
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('default', 'default'),
+            self.rendition('38;2;31')
+        )
+
+    def test_empty_color_arguments(self):
+        # omitted values are 0
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('brightblack', 'default'),
+            self.rendition('38;2;;;')
+        )
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('black', 'red'),
+            self.rendition('38;5;;41')
+        )
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('default', 'brightblack'),
+            self.rendition('48;2;;;')
+        )
+
+    def test_invalid_color_arguments(self):
+        # invalid values are skipped, leaving the following codes
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('red', 'default'),
+            self.rendition('48;2;x;1;2;31')
+        )
+        self.assertEqual(
+            gidterm.TerminalOutput.SelectGraphicRendition('green', 'default'),
+            self.rendition('38;5;abc;32')
+        )
+
+    def test_invalid_color_output(self):
+        output = gidterm.TerminalOutput(None)
+        self.assertEqual(
+            [
+                gidterm.TerminalOutput.SelectGraphicRendition('brightblack', 'default'),
+                gidterm.TerminalOutput.Text('x'),
+                gidterm.TerminalOutput.SelectGraphicRendition('default', 'default'),
+                gidterm.TerminalOutput.Text('y'),
+            ],
+            list(output.handle_output('\x1b[38;2;;;mx\x1b[38;5;?my'))
+        )
+
+
+class SettingsView:
+    # A stand-in for a view, holding only its settings
+
+    class Settings(dict):
+
+        def set(self, key, value):
+            self[key] = value
+
+        def erase(self, key):
+            self.pop(key, None)
+
+    def __init__(self, settings):
+        self._settings = SettingsView.Settings(settings)
+
+    def settings(self):
+        return self._settings
+
+
+class TestCommandHistory(TestCase):
+
+    # Commands saved by older versions, as lists of [begin, end] regions
+    legacy_commands = [
+        [[5, 10]],
+        [[20, 25], [27, 30]],
+        [[30, 35]],
+        [[50, 52], [60, 70]],
+    ]
+
+    def legacy_command_before(self, pos):
+        # last command ending at or before pos, as found by older versions
+        found = None
+        for command in self.legacy_commands:
+            if command[-1][1] <= pos:
+                found = command
+        return found
+
+    def legacy_command_after(self, pos):
+        # first command starting at or after pos, as found by older versions
+        for command in self.legacy_commands:
+            if command[0][0] >= pos:
+                return command
+        return None
+
+    def as_lists(self, regions):
+        if regions is None:
+            return None
+        return [[r.begin(), r.end()] for r in regions]
+
+    def test_load_legacy_history(self):
+        view = SettingsView({'gidterm_command_history': self.legacy_commands})
+        history = gidterm.CommandHistory(view)
+        for pos in range(80):
+            self.assertEqual(
+                self.legacy_command_before(pos),
+                self.as_lists(history.first_command_before(pos)),
+                pos
+            )
+            self.assertEqual(
+                self.legacy_command_after(pos),
+                self.as_lists(history.first_command_after(pos)),
+                pos
+            )
+
+    def test_save_replaces_legacy_history(self):
+        view = SettingsView({'gidterm_command_history': self.legacy_commands})
+        gidterm.CommandHistory(view).save()
+        settings = view.settings()
+        self.assertNotIn('gidterm_command_history', settings)
+        history = gidterm.CommandHistory(view)
+        for i, command in enumerate(self.legacy_commands):
+            self.assertEqual(command, self.as_lists(history.regions(i)))
+
+    def test_empty_history(self):
+        history = gidterm.CommandHistory(SettingsView({}))
+        self.assertIsNone(history.first_command_before(100))
+        self.assertIsNone(history.first_command_after(0))
+
+    def test_append(self):
+        history = gidterm.CommandHistory(SettingsView({}))
+        history.dirty = True  # do not schedule a save
+        history.append([sublime.Region(0, 4), sublime.Region(6, 9)], 10)
+        history.append([sublime.Region(0, 3)], 30)
+        self.assertEqual([[10, 14], [16, 19]], self.as_lists(history.first_command_before(29)))
+        self.assertEqual([[30, 33]], self.as_lists(history.first_command_before(33)))
+        self.assertEqual([[30, 33]], self.as_lists(history.first_command_after(11)))
+        self.assertIsNone(history.first_command_after(31))
+
+
 class TestTimeDeltaSeconds(DeferrableTestCase):
 
     def test_low_fraction(self):